@@ -0,0 +1,42 @@
+"""
+Optional compilation of the file handling modules (protectfile, da_meta) with Cython.
+
+These modules are touched on every metadata access, and consist mostly of attribute
+lookups, path construction and branching, which Cython speeds up without changes to
+the code. They are compiled as-is from the .py sources, which remain the default:
+the package is installed as pure Python, and compiling is opt-in. In a (editable)
+checkout, with Cython and a C compiler available, run
+
+    python build.py
+
+to build the extensions in place, next to the .py sources (which they take
+precedence over on import). When a source is changed after compiling, xdyna warns
+on import and uses the source instead of the outdated extension (see
+xdyna/__init__.py); run this script again to rebuild. Delete the resulting
+xdyna/*.so files to go back to pure Python.
+"""
+
+from setuptools import setup
+from setuptools.command.build_ext import build_ext
+
+compiled_modules = ['xdyna/protectfile.py', 'xdyna/da_meta.py']
+
+
+class OptionalBuildExt(build_ext):
+    """Do not fail if an extension cannot be compiled, as the pure Python module still works."""
+
+    def build_extension(self, ext):
+        try:
+            super().build_extension(ext)
+        except Exception as e:
+            print(f"Warning: could not compile {ext.name} ({e}). Using the pure Python module.")
+
+
+if __name__ == '__main__':
+    from Cython.Build import cythonize
+    setup(
+        name         = 'xdyna',
+        ext_modules  = cythonize(compiled_modules, language_level=3),
+        cmdclass     = {'build_ext': OptionalBuildExt},
+        script_args  = ['build_ext', '--inplace']
+    )
@@ -0,0 +1,107 @@
+import importlib
+import json
+import math
+import os
+import sys
+
+import pytest
+
+from xdyna import da_meta
+from xdyna.da_meta import _DAMetaData
+
+
+def test_batch_update(tmp_path):
+    meta = _DAMetaData(filename=tmp_path / 'study')
+    before = meta.meta_file.read_bytes()
+    with meta.batch_update():
+        meta.turns = 1000
+        meta.emitx = 2.5e-6
+        with meta.batch_update():
+            meta.emity = 3.5e-6
+        # Nothing is written until the outermost context is left
+        assert meta.meta_file.read_bytes() == before
+        assert meta.turns == 1000
+    stored = json.loads(meta.meta_file.read_text())
+    assert (stored['turns'], stored['emitx'], stored['emity']) == (1000, 2.5e-6, 3.5e-6)
+    reloaded = _DAMetaData(filename=tmp_path / 'study')
+    assert (reloaded.turns, reloaded.emitx, reloaded.emity) == (1000, 2.5e-6, 3.5e-6)
+
+
+def test_batch_update_stores_on_failure(tmp_path):
+    meta = _DAMetaData(filename=tmp_path / 'study')
+    with pytest.raises(ValueError):
+        with meta.batch_update():
+            meta.turns = 500
+            meta.emitx = -1
+    # The fields that were set before the failure are kept in sync with the file
+    assert json.loads(meta.meta_file.read_text())['turns'] == 500
+
+
+def test_batch_update_detects_changes(tmp_path):
+    meta = _DAMetaData(filename=tmp_path / 'study')
+    meta.turns = 100
+    other = _DAMetaData(filename=tmp_path / 'study')
+    other.nseeds = 60
+    with pytest.raises(Exception, match="changed on disk"):
+        with meta.batch_update():
+            meta.turns = 200
+
+
+def test_change_detected_within_mtime_tick(tmp_path):
+    meta = _DAMetaData(filename=tmp_path / 'study')
+    meta.turns = 100
+    st = meta.meta_file.stat()
+    # Another write of the same size, with the same mtime (as on file systems with coarse mtimes)
+    other = _DAMetaData(filename=tmp_path / 'study', skip_file_generation=True)
+    other._read()
+    other.turns = 200
+    os.utime(meta.meta_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert meta.meta_file.stat().st_size == st.st_size
+    with pytest.raises(Exception, match="changed on disk"):
+        meta.nseeds = 5
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def json_backend(request, monkeypatch):
+    # Run with orjson, and with orjson blocked (as without the 'fast' extra)
+    if request.param == 'orjson':
+        pytest.importorskip('orjson')
+    else:
+        monkeypatch.setitem(sys.modules, 'orjson', None)
+    importlib.reload(da_meta)
+    yield request.param
+    monkeypatch.undo()
+    importlib.reload(da_meta)
+
+
+def test_non_finite_values(tmp_path, json_backend):
+    meta = da_meta._DAMetaData(filename=tmp_path / 'study')
+    meta.s_start = float('inf')
+    assert da_meta._DAMetaData(filename=tmp_path / 'study').s_start == float('inf')
+    meta.s_start = float('nan')
+    assert math.isnan(da_meta._DAMetaData(filename=tmp_path / 'study').s_start)
+
+
+def test_load_metadata_written_by_json(tmp_path, json_backend):
+    meta = da_meta._DAMetaData(filename=tmp_path / 'study')
+    # As written by older versions, or without orjson
+    stored = json.loads(meta.meta_file.read_text())
+    stored.update({'s_start': float('-inf'), 'pairs_shift_var': float('nan')})
+    meta.meta_file.write_text(json.dumps(stored, indent=2))
+    loaded = da_meta._DAMetaData(filename=tmp_path / 'study')
+    assert loaded.s_start == float('-inf')
+    assert math.isnan(loaded.pairs_shift_var)
+
+
+class _Float(float):
+    # Like numpy.float64, which subclasses float
+    pass
+
+
+def test_float_subclass(tmp_path, json_backend):
+    meta = da_meta._DAMetaData(filename=tmp_path / 'study')
+    meta.emitx = _Float(2.5e-6)
+    meta.update_submissions(0, {'sigma': _Float(1.5)})
+    reloaded = da_meta._DAMetaData(filename=tmp_path / 'study')
+    assert reloaded.emitx == 2.5e-6
+    assert reloaded.submissions == {0: {'sigma': 1.5}}
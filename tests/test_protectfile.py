@@ -0,0 +1,195 @@
+import errno
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from xdyna import ProtectFile, read_locked
+from xdyna import protectfile
+
+
+def _increment(filename, n):
+    for _ in range(n):
+        with ProtectFile(filename, 'r+', wait=0.001) as pf:
+            counter = int(pf.read())
+            pf.truncate(0)
+            pf.seek(0)
+            pf.write(str(counter + 1))
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="Needs fork")
+def test_concurrent_increments(tmp_path):
+    counter = tmp_path / 'counter.txt'
+    counter.write_text('0')
+    ctx = multiprocessing.get_context('fork')
+    nproc, n = 8, 100
+    procs = [ctx.Process(target=_increment, args=(counter, n)) for _ in range(nproc)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+    assert int(counter.read_text()) == nproc*n
+    # No lockfiles, tempfiles, backups, or results are left behind
+    assert [f.name for f in tmp_path.iterdir()] == ['counter.txt']
+
+
+def test_release_only_once(tmp_path):
+    file = tmp_path / 'file.txt'
+    file.write_text('text')
+    lockfile = tmp_path / 'file.txt.lock'
+    first = ProtectFile(file, 'r')
+    with first:
+        assert lockfile.exists()
+    assert not lockfile.exists()
+    with ProtectFile(file, 'r'):
+        # Releasing again (as in __del__) should not remove a lock that is not ours anymore
+        first.release()
+        assert lockfile.exists()
+    assert not lockfile.exists()
+
+
+def _rewrite(filename, n, size):
+    for i in range(n):
+        with ProtectFile(filename, 'r+', wait=0.001) as pf:
+            pf.truncate(0)
+            pf.seek(0)
+            pf.write(str(i % 10)*size)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="Needs fork")
+def test_read_locked(tmp_path):
+    file = tmp_path / 'file.txt'
+    size = 200*1024
+    file.write_text('0'*size)
+    assert read_locked(file) == '0'*size
+    assert read_locked(file, 'rb') == b'0'*size
+    with pytest.raises(ValueError):
+        read_locked(file, 'r+')
+    # While another process keeps rewriting the file, every read sees one full version
+    ctx = multiprocessing.get_context('fork')
+    writer = ctx.Process(target=_rewrite, args=(file, 200, size))
+    writer.start()
+    while writer.is_alive():
+        text = read_locked(file)
+        assert len(text) == size
+        assert text == text[0]*size
+    writer.join()
+    assert writer.exitcode == 0
+    assert read_locked(file) == '9'*size
+
+
+def test_small_file_write(tmp_path):
+    file = tmp_path / 'file.txt'
+    file.write_text('hello world')
+    # Reading the file into memory can update its access time, which should not
+    # be mistaken for a change during the lock
+    old = time.time() - 2*86400
+    os.utime(file, (old, old))
+    with ProtectFile(file, 'r+') as pf:
+        pf.write('HELLO')
+    assert file.read_text() == 'HELLO world'
+    assert [f.name for f in tmp_path.iterdir()] == ['file.txt']
+
+
+def test_small_file_restore(tmp_path):
+    file = tmp_path / 'file.txt'
+    file.write_text('hello world')
+    os.chmod(file, 0o640)
+    mtime = file.stat().st_mtime_ns
+    with ProtectFile(file, 'r+') as pf:
+        pf.write('HELLO')
+        file.write_text('corrupted')
+    # The original is restored from memory, and the result is kept aside
+    assert file.read_text() == 'hello world'
+    assert file.stat().st_mtime_ns == mtime
+    assert file.stat().st_mode & 0o777 == 0o640
+    results = [f for f in tmp_path.iterdir() if f.name != 'file.txt']
+    assert len(results) == 1 and results[0].name.endswith('.result')
+    assert results[0].read_text() == 'HELLO world'
+
+
+def _cross_device(source, destination):
+    raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+
+@pytest.mark.parametrize('check_hash', [False, True, 'strong'])
+def test_cross_device_move(tmp_path, monkeypatch, check_hash):
+    file = tmp_path / 'file.txt'
+    file.write_text('hello world')
+    monkeypatch.setattr(protectfile.os, 'replace', _cross_device)
+    with ProtectFile(file, 'r+', check_hash=check_hash) as pf:
+        pf.write('HELLO')
+    assert file.read_text() == 'HELLO world'
+    assert [f.name for f in tmp_path.iterdir()] == ['file.txt']
+
+
+@pytest.mark.parametrize('check_hash', [True, 'strong'])
+def test_cross_device_failed_copy(tmp_path, monkeypatch, check_hash):
+    file = tmp_path / 'file.txt'
+    file.write_text('hello world')
+    monkeypatch.setattr(protectfile.os, 'replace', _cross_device)
+    # A first copy that silently loses the last byte
+    copies = []
+    def faulty_copy(src, dst):
+        dst.write(src.read()[:-1] if not copies else src.read())
+        copies.append(dst.name)
+    monkeypatch.setattr(protectfile.shutil, 'copyfileobj', faulty_copy)
+    with ProtectFile(file, 'r+', check_hash=check_hash) as pf:
+        pf.write('HELLO')
+    # The failed copy is detected: the original is restored and the result is kept aside
+    assert file.read_text() == 'hello world'
+    results = [f for f in tmp_path.iterdir() if f.name != 'file.txt']
+    assert len(results) == 1 and results[0].name.endswith('.result')
+    assert results[0].read_text() == 'HELLO world'
+
+
+def test_stale_tempfile(tmp_path):
+    file = tmp_path / 'new.txt'
+    # A tempfile left behind by a killed process (with the same PID) does not interfere
+    stale = tmp_path / f'.new.txt.{os.getpid()}.tmp'
+    stale.write_text('stale')
+    with ProtectFile(file, 'x') as pf:
+        pf.write('new')
+    assert file.read_text() == 'new'
+    assert sorted(f.name for f in tmp_path.iterdir()) == sorted(['new.txt', stale.name])
+
+
+def test_new_file_permissions(tmp_path):
+    umask = os.umask(0o022)
+    try:
+        with ProtectFile(tmp_path / 'new.txt', 'w') as pf:
+            pf.write('new')
+    finally:
+        os.umask(umask)
+    assert (tmp_path / 'new.txt').stat().st_mode & 0o777 == 0o644
+
+
+class _FakeMsvcrt:
+    LK_NBLCK, LK_UNLCK = 'lock', 'unlock'
+
+    def __init__(self):
+        self.calls = []
+
+    def locking(self, fd, mode, nbytes):
+        self.calls.append((mode, os.lseek(fd, 0, os.SEEK_CUR), nbytes))
+
+
+def test_lock_fd_without_fcntl(tmp_path, monkeypatch):
+    fake = _FakeMsvcrt()
+    monkeypatch.setattr(protectfile, 'fcntl', None)
+    monkeypatch.setattr(protectfile, 'msvcrt', fake, raising=False)
+    file = tmp_path / 'file.txt'
+    file.write_text('hello world')
+    with open(file, 'r+') as fp:
+        fp.seek(6)
+        with protectfile._lock_fd(fp):
+            # The first byte is locked, without moving the file position
+            assert fake.calls == [('lock', 0, 1)]
+            assert fp.tell() == 6
+            fp.write('WORLD')
+        # And it is unlocked explicitly, after flushing
+        assert fake.calls == [('lock', 0, 1), ('unlock', 0, 1)]
+        assert fp.tell() == 11
+        assert file.read_text() == 'hello WORLD'
@@ -0,0 +1,79 @@
+import json
+import multiprocessing
+import os
+
+import pytest
+
+from xdyna import regenerate_da_metadata
+from xdyna.da_meta import _DAMetaData
+
+
+def test_submissions_append_and_fold(tmp_path):
+    meta = _DAMetaData(filename=tmp_path / 'study')
+    assert meta.submissions == {}
+    assert meta.new_submission_id() == 0
+    assert meta.new_submission_id() == 1
+    meta.update_submissions(0, 'first')
+    meta.update_submissions(1, {'jobs': 3})
+    meta.update_submissions(0, 'second')
+    # One line per update, the last one counts
+    lines = meta.submissions_file.read_text().splitlines()
+    assert len(lines) == 5
+    assert meta.submissions == {0: 'second', 1: {'jobs': 3}}
+    # A fresh object folds the full log
+    reloaded = _DAMetaData(filename=tmp_path / 'study')
+    assert reloaded.submissions == {0: 'second', 1: {'jobs': 3}}
+    # Only what is appended afterwards is read on the next access
+    meta.update_submissions(1, None)
+    assert reloaded.submissions == {0: 'second', 1: None}
+    # Submissions are not stored in the metadata file
+    assert 'submissions' not in json.loads(meta.meta_file.read_text())
+
+
+def _new_ids(filename, n, queue):
+    meta = _DAMetaData(filename=filename, skip_file_generation=True)
+    queue.put([meta.new_submission_id() for _ in range(n)])
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="Needs fork")
+def test_concurrent_submission_ids(tmp_path):
+    meta = _DAMetaData(filename=tmp_path / 'study')
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    nproc, n = 8, 25
+    procs = [ctx.Process(target=_new_ids, args=(meta.meta_file, n, queue)) for _ in range(nproc)]
+    for p in procs:
+        p.start()
+    ids = [i for _ in procs for i in queue.get(timeout=60)]
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+    assert sorted(ids) == list(range(nproc*n))
+    assert meta.submissions == {i: None for i in range(nproc*n)}
+
+
+def test_legacy_submissions_migration(tmp_path):
+    meta = _DAMetaData(filename=tmp_path / 'study')
+    meta.turns = 100
+    # Older studies kept the submissions in the metadata file, with string keys
+    legacy = json.loads(meta.meta_file.read_text())
+    legacy['submissions'] = {'0': 'done', '1': None}
+    meta.meta_file.write_text(json.dumps(legacy, indent=2))
+    assert not meta.submissions_file.exists()
+    migrated = _DAMetaData(filename=tmp_path / 'study')
+    assert migrated.turns == 100
+    assert migrated.submissions_file.exists()
+    assert migrated.submissions == {0: 'done', 1: None}
+    assert migrated.new_submission_id() == 2
+    assert 'submissions' not in json.loads(migrated.meta_file.read_text())
+    # Only migrated once
+    again = _DAMetaData(filename=tmp_path / 'study')
+    assert again.submissions == {0: 'done', 1: None, 2: None}
+
+
+def test_regenerate_metadata_with_submissions(tmp_path):
+    meta = regenerate_da_metadata(tmp_path / 'study.meta.json', turns=50, submissions={'0': 'done'})
+    assert meta.meta_file.exists()
+    assert meta.turns == 50
+    assert _DAMetaData(filename=tmp_path / 'study').submissions == {0: 'done'}
+    assert regenerate_da_metadata(tmp_path / 'study', turns=60) is None
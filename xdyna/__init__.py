@@ -1,5 +1,42 @@
-from .da import DA
+import os, sys, importlib.util
+from importlib.machinery import EXTENSION_SUFFIXES
+
+
+def _skip_outdated_extensions():
+    # The optionally compiled modules (see build.py) take precedence over the .py sources on
+    # import. If a source was changed after compiling, load it instead of the outdated extension.
+    folder = os.path.dirname(__file__)
+    extensions = {}
+    for entry in os.scandir(folder):
+        module, _, suffix = entry.name.partition('.')
+        if '.' + suffix in EXTENSION_SUFFIXES:
+            extensions[module] = entry
+    # In order of dependency (da_meta imports protectfile)
+    for module in ['protectfile', 'da_meta']:
+        if module not in extensions:
+            continue
+        source = os.path.join(folder, module + '.py')
+        if os.stat(source).st_mtime_ns > extensions[module].stat().st_mtime_ns:
+            print(f"Warning: the compiled {extensions[module].name} is older than {module}.py, which is "
+                  + "used instead. Rebuild the extensions with 'python build.py', or delete them.")
+            name = f'{__name__}.{module}'
+            spec = importlib.util.spec_from_file_location(name, source)
+            sys.modules[name] = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(sys.modules[name])
+
+_skip_outdated_extensions()
+
+
 from .da_meta import regenerate_da_metadata
-from .protectfile import ProtectFile, get_hash
+from .protectfile import ProtectFile, get_hash, read_locked
 
 __version__ = '0.0.2'
+
+
+def __getattr__(name):
+    # DA pulls in scipy, pandas, and the xsuite packages, so it is only imported when first used
+    if name == 'DA':
+        from .da import DA
+        globals()['DA'] = DA
+        return DA
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
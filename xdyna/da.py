@@ -38,23 +38,24 @@ class DA:
 #              ]
 
     def __init__(self, filename, *, turns=None, nseeds=None, emittance=None, energy=None):
-        # Initialise metadata
-        self._meta = _DAMetaData(filename=filename)
-        if turns is not None:
-            self.meta.turns = turns
-        if nseeds is not None:
-            self.meta.nseeds = nseeds
-        if emittance is not None:
-            self.meta.emittance = emittance
-        if energy is not None:
-            self.meta.energy = energy
-
         self._surv = None
         self._da = None
         self._da_evol = None
         self._active_job = -1
         self._active_job_log = {}
 
+        # Initialise metadata
+        self._meta = _DAMetaData(filename=filename)
+        with self.meta.batch_update():
+            if turns is not None:
+                self.meta.turns = turns
+            if nseeds is not None:
+                self.meta.nseeds = nseeds
+            if emittance is not None:
+                self.emittance = emittance
+            if energy is not None:
+                self.meta.energy = energy
+
 
     # =================================================================
     # ================ Generation of intial conditions ================
@@ -78,20 +79,21 @@ class DA:
         # If non-default values are specified, copy them to the metadata
         # In the grid generation further below, only the metadat values
         # should be used (and not the function ones)!
-        if emittance is not None:
-            self.emittance = emittance
-        if self.emittance is None:
-            raise ValueError("No emittance defined! Do this first before generating initial conditions")
-        if nseeds is not None:
-            self.meta.nseeds = nseeds
-        if pairs_shift != 0:
-            self.meta.pairs_shift = pairs_shift
-            if pairs_shift_var is None:
-                raise ValueError("Need to set coordinate for the shift between pairs with pairs_shift_var!")
-            else:
-                self.meta.pairs_shift_var = pairs_shift_var
-        elif pairs_shift_var is not None:
-            raise ValueError("Need to set magnitude of shift between pairs with pairs_shift!")
+        with self.meta.batch_update():
+            if emittance is not None:
+                self.emittance = emittance
+            if self.emittance is None:
+                raise ValueError("No emittance defined! Do this first before generating initial conditions")
+            if nseeds is not None:
+                self.meta.nseeds = nseeds
+            if pairs_shift != 0:
+                self.meta.pairs_shift = pairs_shift
+                if pairs_shift_var is None:
+                    raise ValueError("Need to set coordinate for the shift between pairs with pairs_shift_var!")
+                else:
+                    self.meta.pairs_shift_var = pairs_shift_var
+            elif pairs_shift_var is not None:
+                raise ValueError("Need to set magnitude of shift between pairs with pairs_shift!")
 
         # Make the grid in r
         if r_step is None and r_num is None:
@@ -164,8 +166,9 @@ class DA:
             self._surv = pd.concat([self._surv, df])
         with ProtectFile(self.meta.surv_file, 'x+b') as pf:
             self._surv.to_parquet(pf, index=True)
-        self.meta.da_type = 'radial'
-        self.meta.da_dim = 2
+        with self.meta.batch_update():
+            self.meta.da_type = 'radial'
+            self.meta.da_dim = 2
 
 
 
@@ -217,7 +220,7 @@ class DA:
             if linefile.exists():
                 continue
             # Generate line
-            with ProtectFile(linefile, 'x') as pf:
+            with ProtectFile(linefile, 'xb') as pf:
                 print(f"Calculating line{'' if seed=='' else ' for seed ' + seed}.")
                 line = xt.Line.from_sixinput(st.SixInput(seedpath))
                 # TODO: no hardcoding of particle selection as proton
@@ -225,7 +228,8 @@ class DA:
                 # TODO: no hardcoding of RF
                 line['acsca.d5l4.b1'].voltage = 16e6
                 line['acsca.d5l4.b1'].frequency = 400e6
-                json.dump(line.to_dict(), pf, cls=xo.JEncoder)
+                # Serialise in one go and write a single buffer, instead of json.dump's many small writes
+                pf.write(json.dumps(line.to_dict(), cls=xo.JEncoder).encode())
 
     def _set_sixtrack_folder(self, sixtrack_input_folder=None):
         # Check that folder with SixTrack input files exists
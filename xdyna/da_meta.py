@@ -1,8 +1,46 @@
 import numbers
+from contextlib import contextmanager
 from pathlib import Path
 import json
-
-from .protectfile import ProtectFile
+import math
+import os
+
+from .protectfile import read_locked, _acquire_lock, _release_lock, _lock_fd, _unique_tempfile
+
+# orjson is considerably faster than json, but optional. It is only used as a fast path, such
+# that the results do not depend on whether it is installed: whatever orjson cannot encode
+# the same way (non-finite floats, which it would write as null, or types it does not support
+# like numpy floats) or decode (the Infinity and NaN written by json) is left to json.
+def _json_dumps_std(obj, indent=False):
+    return json.dumps(obj, indent=2 if indent else None, sort_keys=False).encode()
+
+def _has_non_finite(obj):
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_non_finite(val) for val in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(val) for val in obj)
+    return False
+
+try:
+    import orjson
+    def _json_dumps(obj, indent=False):
+        if _has_non_finite(obj):
+            return _json_dumps_std(obj, indent)
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        try:
+            return orjson.dumps(obj, option=(option | orjson.OPT_INDENT_2) if indent else option)
+        except orjson.JSONEncodeError:
+            return _json_dumps_std(obj, indent)
+    def _json_loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+except ImportError:
+    _json_dumps = _json_dumps_std
+    _json_loads = json.loads
 
 # Developers: if new metadata is added, the following steps have to be implemented:
 #    - description in docstring
@@ -19,7 +57,7 @@ def regenerate_da_metadata(filename, *, da_type=None, da_dim=None, emitx=None, e
     """Function to manually regenerate the *.meta.json file, in case it got corrupted or deleted.
     
     """
-    meta = _DAMetaData(filename, skip_file_generation=True)
+    meta = _DAMetaData(filename=filename, skip_file_generation=True)
     if meta.meta_file.exists():
         print("Warning: metadata file already exists! Not regenerated.")
     else:
@@ -33,11 +71,20 @@ def regenerate_da_metadata(filename, *, da_type=None, da_dim=None, emitx=None, e
         meta._pairs_shift = pairs_shift
         meta._pairs_shift_var = pairs_shift_var
         meta._s_start = s_start
-        meta._submissions = submissions
         meta._store()
+        if submissions and not meta.submissions_file.exists():
+            meta._write_submissions(submissions)
         return meta
 
 
+def _fold_submissions(lines, submissions):
+    # Every line in the submissions file is an update of one submission; the last one counts
+    for line in lines:
+        if line.strip():
+            entry = _json_loads(line)
+            submissions[entry['id']] = entry['val']
+
+
 class _DAMetaData:
     """Collects all info of a DA study, and keeps the .meta.json file in sync.
     
@@ -94,10 +141,14 @@ class _DAMetaData:
         Path to the da file (*.da.parquet)
     da_evol_file : pathlib.Path
         Path to the da evolution file (*.da_evol.parquet)
-    submissions : list
+    submissions_file : pathlib.Path
+        Path to the submissions log (*.submissions.jsonl)
+    submissions : dict
         A log with info about the submitted jobs. A new job ID can be
         generated with new_submission_id, and the log can be updated with
-        update_submissions.
+        update_submissions. It is not stored in the .meta.json file, but
+        appended to the submissions_file (one line per update), which is
+        read lazily: only the lines that are new since the last access.
     """
 
     # Class Attributes
@@ -108,15 +159,27 @@ class _DAMetaData:
     #      They need to have a .to_posix() call before storing in the json
     # _auto_cols are calculated automatically and do not need to be read in
     # _optional_cols will not be stored to the json if their value is None
+    # The frozensets and _non_auto_cols are precomputed from these, for fast lookups
     
     _cols = ['name','path','da_type','da_dim','emitx','emity','turns','energy','nseeds','pairs_shift','pairs_shift_var',\
-             's_start','meta_file','line_file','six_path','surv_file','da_file','da_evol_file','submissions']
-    _path_cols = ['path','meta_file','line_file','six_path','surv_file','da_file','da_evol_file']
-    _auto_cols = ['name','path','meta_file','surv_file','da_file','da_evol_file']
+             's_start','meta_file','line_file','six_path','surv_file','da_file','da_evol_file','submissions_file']
+    _path_cols = ['path','meta_file','line_file','six_path','surv_file','da_file','da_evol_file','submissions_file']
+    _auto_cols = ['name','path','meta_file','surv_file','da_file','da_evol_file','submissions_file']
     _optional_cols = ['six_path','line_file']
+    _path_cols_set     = frozenset(_path_cols)
+    _auto_cols_set     = frozenset(_auto_cols)
+    _non_auto_cols     = tuple(sorted(set(_cols) - _auto_cols_set, key=_cols.index))
     # used to specify the accepted DA types
     _da_types=['radial', 'grid', 'monte_carlo', 'free']
 
+    # Only these attributes exist: assigning a field that is not one of the properties
+    # raises an AttributeError, instead of creating an attribute that is never stored
+    __slots__ = ('_filename', '_name', '_path', '_meta_file', '_surv_file', '_da_file', '_da_evol_file',
+                 '_submissions_file', '_da_type', '_da_dim', '_emitx', '_emity', '_turns', '_energy', '_nseeds',
+                 '_pairs_shift', '_pairs_shift_var', '_s_start', '_submissions', '_six_path', '_line_file',
+                 '_submissions_offset', '_batching', '_batch_changed', '_last_ino', '_last_mtime_ns', '_last_size',
+                 '_last_serialized')
+
     _da_type_default         = None
     _da_dim_default          = None
     _emitx_default           = None
@@ -131,10 +194,19 @@ class _DAMetaData:
 
 
     def __init__(self, *, filename, skip_file_generation=False):
+        # Resolve only once: the automatic paths below are built from this without resolving again
         self._filename = Path(filename).resolve()
         if self._filename.suffixes[-2:] == ['.meta', '.json']:
             # Remove .meta.json suffix if passed with filename
             self._filename = Path(self._filename.parent, '.'.join(self._filename.name.split('.')[:-2]))
+        # The automatic paths only depend on the filename, so they are built once
+        self._name            = self._filename.name
+        self._path            = self._filename.parent
+        self._meta_file       = Path(self._path, self._name + '.meta.json')
+        self._surv_file       = Path(self._path, self._name + '.surv.parquet')
+        self._da_file         = Path(self._path, self._name + '.da.parquet')
+        self._da_evol_file    = Path(self._path, self._name + '.da_evol.parquet')
+        self._submissions_file = Path(self._path, self._name + '.submissions.jsonl')
         self._da_type         = self._da_type_default
         self._da_dim          = self._da_dim_default
         self._emitx           = self._emitx_default
@@ -145,9 +217,16 @@ class _DAMetaData:
         self._pairs_shift     = self._pairs_shift_default
         self._pairs_shift_var = self._pairs_shift_var_default
         self._s_start         = self._s_start_default
-        self._submissions     = self._submissions_default
+        self._submissions     = dict(self._submissions_default)
+        self._submissions_offset = 0
         self._six_path        = None
         self._line_file        = None
+        self._batching        = False
+        self._last_ino        = None
+        self._last_mtime_ns   = None
+        self._last_size       = None
+        self._last_serialized = None
+        self._batch_changed   = []
         if not skip_file_generation:
             if self.meta_file.exists():
                 print("Loading existing DA object.")
@@ -167,15 +246,15 @@ class _DAMetaData:
 
     @property
     def name(self):
-        return self._filename.name
+        return self._name
 
     @property
     def path(self):
-        return self._filename.parent
+        return self._path
 
     @property
     def meta_file(self):
-        return Path(self.path, self.name + '.meta.json').resolve()
+        return self._meta_file
 
     @property
     def line_file(self):
@@ -183,8 +262,10 @@ class _DAMetaData:
 
     @line_file.setter
     def line_file(self, line_file):
-        line_file = Path(line_file).resolve()
-        self._set_property('line_file', line_file)
+        line_file = Path(line_file)
+        if line_file != self._line_file:
+            # Only resolve when changed; the stored value is already resolved
+            self._set_property('line_file', line_file.resolve())
 
     @property
     def six_path(self):
@@ -192,22 +273,30 @@ class _DAMetaData:
 
     @six_path.setter
     def six_path(self, six_path):
-        six_path = Path(six_path).resolve()
+        six_path = Path(six_path)
+        if six_path == self._six_path:
+            # Already resolved and checked when it was set
+            return
+        six_path = six_path.resolve()
         if not six_path.exists():
             raise ValueError(f"The path {six_path} does not exist!")
         self._set_property('six_path', six_path)
 
     @property
     def surv_file(self):
-        return Path(self.path, self.name + '.surv.parquet').resolve()
+        return self._surv_file
 
     @property
     def da_file(self):
-        return Path(self.path, self.name + '.da.parquet').resolve()
+        return self._da_file
 
     @property
     def da_evol_file(self):
-        return Path(self.path, self.name + '.da_evol.parquet').resolve()
+        return self._da_evol_file
+
+    @property
+    def submissions_file(self):
+        return self._submissions_file
 
     @property
     def da_type(self):
@@ -318,79 +407,158 @@ class _DAMetaData:
 
     @property
     def submissions(self):
+        # Only read what was appended since the last time
+        if self.submissions_file.exists():
+            with open(self.submissions_file, 'rb') as fp, _lock_fd(fp, exclusive=False):
+                self._read_new_submissions(fp)
         return self._submissions
 
     # Allowed on parallel process
     def new_submission_id(self):
-        with ProtectFile(self.meta_file, 'r+', wait=0.005) as pf:
-            meta = json.load(pf)
-            new_id = len(meta['submissions'].keys())
-            meta['submissions'][new_id] = None
-            pf.truncate(0)  # Delete file contents (to avoid appending)
-            pf.seek(0)      # Move file pointer to start of file
-            json.dump(meta, pf, indent=2, sort_keys=False)
-            self._submissions = meta
-            return new_id
+        # The submissions file is only appended to, under a lock on the file itself
+        with open(self.submissions_file, 'a+b') as fp, _lock_fd(fp):
+            self._read_new_submissions(fp)
+            new_id = len(self._submissions)
+            self._submissions[new_id] = None
+            fp.write(_json_dumps({'id': new_id, 'val': None}) + b'\n')
+            fp.flush()
+            self._submissions_offset = fp.tell()
+        return new_id
 
     # Allowed on parallel process
     def update_submissions(self, submission_id, val):
-        with ProtectFile(self.meta_file, 'r+', wait=0.005) as pf:
-            meta = json.load(pf)
-            meta['submissions'].update({submission_id: val})
-            pf.truncate(0)  # Delete file contents (to avoid appending)
-            pf.seek(0)      # Move file pointer to start of file
-            json.dump(meta, pf, indent=2, sort_keys=False)
-            self._submissions = meta
+        # The offset is not moved, as other processes might have appended before us
+        with open(self.submissions_file, 'ab') as fp, _lock_fd(fp):
+            fp.write(_json_dumps({'id': submission_id, 'val': val}) + b'\n')
+        self._submissions[submission_id] = val
+
+    def _read_new_submissions(self, fp):
+        # Fold the lines after the offset that was read up to (by this object) into the
+        # submissions dict. If the file got shorter, it has been replaced: start over
+        if os.fstat(fp.fileno()).st_size < self._submissions_offset:
+            self._submissions = {}
+            self._submissions_offset = 0
+        fp.seek(self._submissions_offset)
+        _fold_submissions(fp, self._submissions)
+        self._submissions_offset = fp.tell()
+
+    def _write_submissions(self, submissions):
+        with open(self.submissions_file, 'ab') as fp, _lock_fd(fp):
+            fp.write(b''.join(_json_dumps({'id': int(key), 'val': val}) + b'\n' for key, val in submissions.items()))
+        self._submissions.update({int(key): val for key, val in submissions.items()})
+
+    @contextmanager
+    def batch_update(self):
+        """Context to set several fields at once, writing the .meta.json file only once.
+
+        Inside the context, setters only update the fields in memory. When leaving
+        the context, the file is checked and stored once for all changed fields.
+
+        >>> with meta.batch_update():
+        >>>     meta.turns = 1000
+        >>>     meta.emitx = 2.5e-6
+        """
+        if self._batching:
+            # Nested context: the outermost one does the storing
+            yield self
+            return
+        self._batching = True
+        self._batch_changed = []
+        try:
+            yield self
+        finally:
+            # Store even on failure, to keep memory and file in sync
+            self._batching = False
+            changed, self._batch_changed = self._batch_changed, []
+            if changed:
+                self._check_not_changed(ignore=changed)
+                self._store()
 
     def _set_property(self, prop, val):
         if getattr(self, '_' + prop) != val:
             setattr(self, '_' + prop, val)
-            self._check_not_changed(ignore=[prop])
-            self._store()
+            if self._batching:
+                self._batch_changed.append(prop)
+            else:
+                self._check_not_changed(ignore=[prop])
+                self._store()
 
     # TODO: is this superfluous?
-    def _check_not_changed(self, ignore=[]):
+    def _check_not_changed(self, ignore=()):
+        # If the file is exactly as we stored it last, it cannot have changed. Every store
+        # replaces the file, so any other write gives it a new inode (also within one mtime tick)
+        st = self.meta_file.stat()
+        if st.st_ino == self._last_ino and st.st_mtime_ns == self._last_mtime_ns \
+                and st.st_size == self._last_size:
+            return
+        # Load file; if its contents are identical to what we stored last, it did not change either
+        data = read_locked(self.meta_file, 'rb')
+        if data == self._last_serialized:
+            return
         # Create dict of self fields, ignoring the field that is expected to change
         # Also ignore optional keys that are not set
-        ignore += [ x for x in self._optional_cols if getattr(self, x) is None ]
+        ignore = self._unset_optional_cols().union(ignore)
         sortkeys = [ x for x in self._cols if x not in ignore ]
         thisdict = { key: getattr(self, key) for key in sortkeys }
         # Special treatment for paths: make them strings
         self._paths_to_strings(thisdict, ignore)
-        # Load file
-        with ProtectFile(self.meta_file, 'r') as pf:
-            meta = json.load(pf)
+        meta = _json_loads(data)
         meta = { key: meta[key] for key in sortkeys }
         # Compare
         if meta != thisdict:
             raise Exception("The metadata file changed on disk!\n" \
                            + "This is not supposed to happen, and probably means that one of the child processes " \
-                           + "tried to write to it (which is only allowed for the 'submissions' field).\n" \
+                           + "tried to write to it (which is not allowed; submissions are logged in the " \
+                           + "*.submissions.jsonl file instead).\n" \
                            + "Please check your workflow.")
 
     def _read(self):
         # Do not read _auto_cols; these are calculated automatically.
-        with ProtectFile(self.meta_file, 'r') as pf:
-            meta = json.load(pf)
-            for key in [ x for x in self._cols if x not in self._auto_cols ]:
-                # Default to None, in case of optional keys
-                val = meta.get(key, None)
-                if key in self._path_cols and val is not None:
-                    val = Path(val)
-                setattr(self, '_' + key, val )
+        meta = _json_loads(read_locked(self.meta_file, 'rb'))
+        for key in self._non_auto_cols:
+            # Default to None, in case of optional keys
+            val = meta.get(key, None)
+            if key in self._path_cols_set and val is not None:
+                val = Path(val)
+            setattr(self, '_' + key, val )
+        # Older studies kept the submissions inside the .meta.json file
+        if meta.get('submissions', {}) and not self.submissions_file.exists():
+            self._write_submissions(meta['submissions'])
 
     def _store(self):
         # Store everything except  the optional keys that are None
-        ignore = [ x for x in self._optional_cols if getattr(self, x) is None ]
+        ignore = self._unset_optional_cols()
         sortkeys = [ x for x in self._cols if x not in ignore ]
         meta = { key: getattr(self, key) for key in sortkeys }
         self._paths_to_strings(meta, ignore)
-        mode = 'r+' if self.meta_file.exists() else 'x+'
-        with ProtectFile(self.meta_file, mode) as pf:
-            if mode == 'r+':
-                pf.truncate(0)  # Delete file contents (to avoid appending)
-                pf.seek(0)      # Move file pointer to start of file
-            json.dump(meta, pf, indent=2, sort_keys=False)
+        self._store_fast(_json_dumps(meta, indent=True))
+
+    def _store_fast(self, data):
+        # The metadata file is small and only written by the main process, so the
+        # copy-to-temp, backup and hash machinery of ProtectFile is not needed. We
+        # take the same lock, write the full data to a temporary file next to the
+        # metadata file, and atomically move it in place.
+        lockfile = Path(self.path, self.meta_file.name + '.lock')
+        flock = _acquire_lock(lockfile, wait=0.005)
+        tempfile = None
+        try:
+            tempfile = _unique_tempfile(self.meta_file)
+            with open(tempfile, 'wb') as fp:
+                fp.write(data)
+            os.replace(tempfile, self.meta_file)
+            # Remember the file stats, to quickly verify later that it did not change
+            st = self.meta_file.stat()
+            self._last_ino      = st.st_ino
+            self._last_mtime_ns = st.st_mtime_ns
+            self._last_size     = st.st_size
+            self._last_serialized = data
+        finally:
+            if tempfile is not None:
+                tempfile.unlink(missing_ok=True)
+            _release_lock(flock, lockfile)
     
-    def _paths_to_strings(self, meta, ignore=[]):
+    def _unset_optional_cols(self):
+        return frozenset(x for x in self._optional_cols if getattr(self, x) is None)
+
+    def _paths_to_strings(self, meta, ignore=frozenset()):
         meta.update({key: getattr(self,key).as_posix() for key in self._path_cols if key not in ignore})
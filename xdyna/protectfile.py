@@ -4,22 +4,34 @@ This package is an attempt to make file reading/writing (possibly concurrent) mo
 Last update 18/04/2022 - F.F. Van der Veken
 """
 
-import io, shutil, time, pathlib, tempfile, datetime, atexit, hashlib
-# import os, inspect, socket
+import io, os, errno, stat, shutil, time, pathlib, datetime, atexit, hashlib, secrets
+from contextlib import contextmanager
+# import inspect, socket
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
 
-tempdir = tempfile.TemporaryDirectory()
 protected_open = {}
 
+# Files smaller than this (in bytes) are backed up in memory instead of on disk
+SMALL_FILE_THRESHOLD = 64*1024
+
 def exit_handler():
-    """This handles cleaning of potential leftover lockfiles and backups."""
+    """This handles cleaning of potential leftover lockfiles, tempfiles, and backups."""
     for file in protected_open.values():
         file.release(pop=False)
-    tempdir.cleanup()
 atexit.register(exit_handler)
 
-def get_hash(filename, size=128):
-    """Get a fast hash of a file, in chunks of 'size' (in kb)"""
-    h  = hashlib.blake2b()
+def get_hash(filename, size=128, digest_size=64):
+    """Get a fast hash of a file, in chunks of 'size' (in kb), with a digest of 'digest_size' bytes"""
+    if hasattr(hashlib, 'file_digest'):
+        # Python 3.11+: the full read-and-hash loop is done in C (and 'size' is not used)
+        with open(filename, 'rb') as f:
+            return hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=digest_size)).hexdigest()
+    h  = hashlib.blake2b(digest_size=digest_size)
     b  = bytearray(size*1024)
     mv = memoryview(b)
     with open(filename, 'rb', buffering=0) as f:
@@ -28,6 +40,175 @@ def get_hash(filename, size=128):
     return h.hexdigest()
 
 
+def _move(source, destination, check=False):
+    """Move 'source' to 'destination', atomically if both are on the same file system.
+
+    An atomic rename cannot fail halfway, so it is not verified. Only when the file is
+    copied instead (across file systems), the copy is verified if 'check' is set: True
+    compares the file stats, 'strong' the hashes. If the copy failed, the source is kept.
+    Returns whether the move succeeded.
+    """
+    try:
+        os.replace(source, destination)
+        return True
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    # Cross-device: fall back to a copy, which is not atomic, hence done
+    # under an exclusive lock on the destination (see read_locked)
+    with open(source, 'rb') as src, open(destination, 'ab') as dst, _lock_fd(dst):
+        dst.truncate(0)
+        shutil.copyfileobj(src, dst)
+    shutil.copystat(source, destination)
+    if check == 'strong':
+        succeeded = get_hash(source, digest_size=16) == get_hash(destination, digest_size=16)
+    elif check:
+        succeeded = _stat_fingerprint(source) == _stat_fingerprint(destination)
+    else:
+        succeeded = True
+    if succeeded:
+        pathlib.Path(source).unlink()
+    return succeeded
+
+def _unique_tempfile(file, suffix='.tmp'):
+    """Create an empty file with a unique name next to 'file', and return its path.
+
+    The name is random, such that neither a file left behind by a killed process (with a
+    PID that is reused later) nor another thread can clash with it. Unlike mkstemp, the
+    file gets the default permissions.
+    """
+    file = pathlib.Path(file)
+    while True:
+        temp = pathlib.Path(file.parent, f'.{file.name}.{secrets.token_hex(4)}{suffix}')
+        try:
+            os.close(os.open(temp, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+            return temp
+        except FileExistsError:
+            pass
+
+def _stat_fingerprint(filename):
+    """Get the size and modification time of a file, which are preserved when moving or copying it (copy2)"""
+    st = pathlib.Path(filename).stat()
+    return st.st_size, st.st_mtime_ns
+
+def _same_stat(st1, st2):
+    """Compare two stat results, ignoring the access time (which changes by merely reading the file)"""
+    return (st1.st_ino, st1.st_dev, st1.st_size, st1.st_mtime_ns, st1.st_ctime_ns) \
+        == (st2.st_ino, st2.st_dev, st2.st_size, st2.st_mtime_ns, st2.st_ctime_ns)
+
+@contextmanager
+def _lock_fd(fp, exclusive=True, wait=0.001):
+    """Lock an open file pointer (blocking), shared or exclusive, for the duration of the context.
+
+    On POSIX this blocks in the kernel (flock). Windows only has exclusive locks (on the
+    first byte of the file), and we retry every 'wait' seconds. The file position is left
+    untouched, and pending writes are flushed before unlocking.
+    """
+    if fcntl is not None:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield fp
+        finally:
+            fp.flush()
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+    else:
+        _lock_first_byte(fp, msvcrt.LK_NBLCK, wait)
+        try:
+            yield fp
+        finally:
+            fp.flush()
+            # Regions have to be unlocked explicitly before closing the file
+            _lock_first_byte(fp, msvcrt.LK_UNLCK, wait)
+
+def _lock_first_byte(fp, mode, wait):
+    # msvcrt locks from the current position, which is restored afterwards
+    position = fp.tell()
+    fp.seek(0)
+    try:
+        while True:
+            try:
+                msvcrt.locking(fp.fileno(), mode, 1)
+                return
+            except OSError:
+                if mode == msvcrt.LK_UNLCK:
+                    raise
+                time.sleep(wait)
+    finally:
+        fp.seek(position)
+
+def read_locked(file, mode='r'):
+    """Read the full contents of 'file' ('r' for text or 'rb' for bytes) under a shared lock.
+
+    This is a lightweight alternative to a read-only ProtectFile, meant for small files
+    that only need to be read consistently: the lock is taken on the file itself, and
+    no lockfile is created. This is safe as files are always replaced atomically when
+    written by ProtectFile or the metadata, or written under an exclusive lock on the
+    file itself otherwise.
+    """
+    if mode not in ['r', 'rb']:
+        raise ValueError("read_locked only supports the modes 'r' and 'rb'!")
+    with io.open(file, mode) as fp, _lock_fd(fp, exclusive=False):
+        return fp.read()
+
+def _acquire_lock(lockfile, wait=1):
+    """Lock 'lockfile' exclusively and return its file pointer.
+
+    On POSIX the lock is an flock on the lockfile, so waiting happens in the kernel. On
+    other systems (Windows) nothing changed: the lockfile is created exclusively, waiting
+    'wait' seconds between attempts.
+
+    The flock protocol does not exclude processes running an older xdyna, which still
+    wait for the lockfile to disappear (while a new process locks an existing lockfile
+    straight away). Hence all processes working on the same files should run the same
+    version: do not upgrade while jobs are running.
+    """
+    if fcntl is not None:
+        while True:
+            flock = io.open(lockfile, 'a')
+            fcntl.flock(flock.fileno(), fcntl.LOCK_EX)
+            # The previous owner removes the lockfile when releasing it, so we might
+            # have locked a file that is already unlinked. If so, try again.
+            try:
+                if os.path.samestat(os.fstat(flock.fileno()), os.stat(lockfile)):
+                    return flock
+            except FileNotFoundError:
+                pass
+            flock.close()
+    while True:
+        try:
+            flock = io.open(lockfile, 'x')
+#             # TODO:  what follows is irrelevant as this is not written until file is closed,
+#             # which only happens at cleanup
+#             # Write info in lock for debugging
+#             locktext =  'Timestamp:  ' + datetime.datetime.now().isoformat() + '\n'
+#             locktext += 'Hostname:   ' + socket.gethostname() + '\n'
+#             locktext += 'Local IP:   ' + socket.gethostbyname(socket.gethostname()) + '\n'
+#             locktext += 'Process ID: ' + str(os.getpid()) + '\n\n'
+#             frameinfo = ['frame', 'filename', 'lineno', 'function', 'code_context', 'index']
+#             for i, st in enumerate(inspect.stack()):
+#                 locktext += 'Stack ' + str(i) + ':' + os.linesep
+#                 for j, fr in enumerate(st):
+#                     locktext += frameinfo[j] + ': ' + str(fr) + os.linesep
+#                 locktext += os.linesep
+#             flock.write(locktext)
+            return flock
+        except (IOError, OSError, FileExistsError):
+            time.sleep(wait)
+
+def _release_lock(flock, lockfile):
+    """Remove a lockfile and close its file pointer, if the lock is still held."""
+    if flock.closed:
+        # Already released; the lockfile might belong to another process by now
+        return
+    if fcntl is not None:
+        # Unlink while still holding the lock, see _acquire_lock
+        lockfile.unlink(missing_ok=True)
+        flock.close()
+    else:
+        flock.close()
+        lockfile.unlink(missing_ok=True)
+
+
 class ProtectFile:
     """A wrapper around a file pointer, protecting it with a lockfile and backups.
     
@@ -36,7 +217,8 @@ class ProtectFile:
     It is meant to be used inside a context, where the entering and leaving of a
     context ensures the file protection. The moment the object is instantiated, a
     lockfile is generated (which is destroyed after leaving the context). Attempts
-    to access the file will be postponed as long as a lockfile exists. Furthermore,
+    to access the file will be postponed as long as the lockfile is locked (on
+    POSIX, by an flock) or exists (on Windows). Furthermore,
     while in the context, file operations are done on a temporary file, that is
     only moved back when leaving the context.
 
@@ -60,17 +242,20 @@ class ProtectFile:
     lockfile   : pathlib.Path
         The path to the lockfile.
     tempfile   : pathlib.Path
-        The path to a temporary file which will accumulate all writes until the
-        ProtectFile object is destroyed, at which point the temporary file will
-        replace the original file. Not used when a ProtectFile object is
-        instantiated in read-only mode ('r' or 'rb').
+        The path to a temporary file (in the same folder, with a unique name) which
+        will accumulate all writes until the ProtectFile object is destroyed, at which
+        point the temporary file will (atomically) replace the original file. Not used
+        (and None) when a ProtectFile object is instantiated in read-only mode ('r' or
+        'rb').
     backupfile : pathlib.Path
         The path to a backup file in the same folder. This is to not lose the file
         in case of a catastrophic crash. This can be switched off by setting
         'backup_during_lock'=False. On the other hand, the option 'backup'=True
         will keep the backup file even after destroying the ProtectFile object. Not
         used when a ProtectFile object is instantiated in read-only mode ('r' or
-        'rb'), unless 'backup_if_readonly'=True.
+        'rb'), unless 'backup_if_readonly'=True. For files smaller than
+        SMALL_FILE_THRESHOLD, the backup is kept in memory instead (and this is
+        None), unless 'backup'=True.
     
     Examples
     --------
@@ -110,6 +295,11 @@ class ProtectFile:
     >>>     pf.seek(0)              # Move file pointer to start of file
     >>>     data.to_parquet(pf, index=True)
     """
+
+    # One object is created per file access. Unset slots still raise an AttributeError,
+    # so the hasattr checks in release() keep working on partially initialised objects
+    __slots__ = ('_file', '_lock', '_temp', '_flock', '_fd', '_backup', '_exists', '_fstat', '_readonly',
+                 '_do_backup', '_keep_backup', '_backup_if_readonly', '_check_hash', '_original')
     
     def __init__(self, *args, **kwargs):
         """A ProtectFile object, to be used only in a context.
@@ -118,6 +308,8 @@ class ProtectFile:
         ---------
         wait : int, default 1
             When a file is locked, the time to wait before trying to acess it again.
+            Only used on systems without fcntl, as otherwise the waiting is done by
+            the kernel.
         backup_during_lock : bool, default True
             Whether or not to use a temporary backup file, to restore in case of
             failure.
@@ -127,9 +319,14 @@ class ProtectFile:
         backup_if_readonly : bool, default False
             Whether or not to use the backup mechanism when a file is in read-only
             mode ('r' or 'rb').
-        check_hash : bool, default True
-            Whether or not to verify by hash that the move of the temporary file to
-            the original file succeeded.
+        check_hash : bool or 'strong', default False
+            Whether or not to verify that the move of the temporary file to the
+            original file succeeded. If True, the file size and modification time
+            are compared (no file content is read). If 'strong', the file contents
+            are compared by hash. As the temporary file is next to the original
+            file, it is normally moved by an atomic rename, which is not verified;
+            this check only applies when the file system does not allow this and
+            the temporary file is copied instead.
         
         Additionally, the following parameters are inherited from open():
             'file', 'mode', 'buffering', 'encoding', 'errors', 'newline', 'closefd', 'opener'
@@ -148,40 +345,28 @@ class ProtectFile:
         if self._keep_backup:
             self._do_backup = True
         self._backup_if_readonly = arg.pop('backup_if_readonly', False)
-        self._check_hash = arg.pop('check_hash', True)
+        self._check_hash = arg.pop('check_hash', False)
 
         # Initialise paths
+        # Only the file itself is resolved; the derived paths are in the same (resolved) folder
         arg['file'] = pathlib.Path(arg['file']).resolve()
         file = arg['file']
         self._file = file
-        self._lock = pathlib.Path(file.parent, file.name + '.lock').resolve()
-        self._temp = pathlib.Path(tempdir.name, file.name).resolve()
+        self._lock = pathlib.Path(file.parent, file.name + '.lock')
+        # Only created once the lock is acquired (and only when writing)
+        self._temp = None
 
-        # Try to make lockfile, wait if unsuccesful
-        while True:
-            try:
-                self._flock = io.open(self._lock, 'x')
-#                 # TODO:  what follows is irrelevant as this is not written until file is closed,
-#                 # which only happens at cleanup
-#                 # Write info in lock for debugging
-#                 locktext =  'Timestamp:  ' + datetime.datetime.now().isoformat() + '\n'
-#                 locktext += 'Hostname:   ' + socket.gethostname() + '\n'
-#                 locktext += 'Local IP:   ' + socket.gethostbyname(socket.gethostname()) + '\n'
-#                 locktext += 'Process ID: ' + str(os.getpid()) + '\n\n'
-#                 frameinfo = ['frame', 'filename', 'lineno', 'function', 'code_context', 'index']
-#                 for i, st in enumerate(inspect.stack()):
-#                     locktext += 'Stack ' + str(i) + ':' + os.linesep
-#                     for j, fr in enumerate(st):
-#                         locktext += frameinfo[j] + ': ' + str(fr) + os.linesep
-#                     locktext += os.linesep
-#                 self._flock.write(locktext)
-                break
-            except (IOError, OSError, FileExistsError):
-                time.sleep(wait)
+        # Lock the lockfile, wait if unsuccesful
+        self._flock = _acquire_lock(self._lock, wait)
 
         # Clean up modes: we only use 'x' and 'r' (not 'w' and 'r') to have clear
         # flow on new vs existing files
-        self._exists = True if file.is_file() else False
+        # A single stat, to check existence and to store the stats (to check if file got corrupted later)
+        try:
+            self._fstat = file.stat()
+            self._exists = True
+        except FileNotFoundError:
+            self._exists = False
         mode = arg.get('mode','r')
         self._readonly = False
         if 'r' in mode:
@@ -198,23 +383,36 @@ class ProtectFile:
             else:
                 arg['mode'] = arg['mode'].replace("w", "x").replace("a", "x")
 
-        # Make a backup if requested
+        # Small files are read into memory once, which then serves as backup and as
+        # source for the tempfile (instead of copying the file twice). Unless the
+        # backup has to be kept, as then it is needed on disk.
         if self._readonly and not self._backup_if_readonly:
             self._do_backup = False
-        if self._do_backup and self._exists:
-            self._backup = pathlib.Path(file.parent, file.name + '.backup').resolve()
+        if self._exists and (self._do_backup or not self._readonly) and not self._keep_backup \
+                and self._fstat.st_size < SMALL_FILE_THRESHOLD:
+            self._original = file.read_bytes()
+        else:
+            self._original = None
+
+        # Make a backup if requested
+        if self._do_backup and self._exists and self._original is None:
+            self._backup = pathlib.Path(file.parent, file.name + '.backup')
             shutil.copy2(self._file, self._backup)
         else:
             self._backup = None
 
-        # Store stats (to check if file got corrupted later)
-        if self._exists:
-            self._fstat = file.stat()
-
         # Choose file pointer:
         # Temporary if writing, or existing file if read-only
         if not self._readonly:
-            if self._exists:
+            # The tempfile lives next to the file, such that it can be moved in place atomically.
+            # It already exists, so a new file is opened with 'w' instead of 'x' (the check
+            # on the existence of the file itself is done above).
+            self._temp = _unique_tempfile(file)
+            arg['mode'] = arg['mode'].replace("x", "w")
+            if self._original is not None:
+                self._temp.write_bytes(self._original)
+                shutil.copystat(self._file, self._temp)
+            elif self._exists:
                 shutil.copy2(self._file, self._temp)
             arg['file'] = self._temp        
         self._fd = io.open(**arg)
@@ -237,7 +435,7 @@ class ProtectFile:
         # TODO: verify that checking file stats is 1) enough, and 2) not
         #       potentially problematic on certain file systems (i.e. if the
         #       system would periodically access the file, this would fail)
-        if self._exists and (self.file.stat()!= self._fstat):
+        if self._exists and not _same_stat(self.file.stat(), self._fstat):
             print(f"Error: File {self.file} changed during lock!")
             # If corrupted, restore from backup
             # and move result of calculation (i.e. tempfile) to the parent folder
@@ -252,25 +450,36 @@ class ProtectFile:
         if not self._readonly:
             if destination is None:
                 # Move temporary file to original file
-                shutil.copy2(self._temp, self.file)
-                # Check if copy succeeded
-                if self._check_hash and get_hash(self._temp) != get_hash(self.file):
+                if not _move(self._temp, self.file, check=self._check_hash):
                     print(f"Warning: tried to copy temporary file {self._temp} into {self.file}, "
-                          + "but hashes do not match!")
+                          + f"but {'hashes' if self._check_hash == 'strong' else 'file stats'} do not match!")
+                    # The tempfile is kept, so restoring saves it as the result
                     self.restore()
             else:
-                shutil.copy2(self._temp, destination)
-            self._temp.unlink()
+                _move(self._temp, destination)
 
 
     def restore(self):
         """Restore the original file from backup and save calculation results"""
-        if self._do_backup:
-            self._backup.rename(self.file)
+        if self._do_backup and self._exists:
+            if self._backup is None:
+                # Small file, backed up in memory: write it next to the file and move it
+                # in place, as readers rely on the file being replaced atomically
+                restored = _unique_tempfile(self.file, suffix='.restore')
+                try:
+                    restored.write_bytes(self._original)
+                    # Same mode and times as the original, like the rename of a copy2 backup
+                    os.chmod(restored, stat.S_IMODE(self._fstat.st_mode))
+                    os.utime(restored, ns=(self._fstat.st_atime_ns, self._fstat.st_mtime_ns))
+                    _move(restored, self.file)
+                finally:
+                    restored.unlink(missing_ok=True)
+            else:
+                self._backup.rename(self.file)
             print('Restored file to previous state.')
         if not self._readonly:
             alt_file = pathlib.Path(self.file.parent, self.file.name + '__' \
-                       + datetime.datetime.now().isoformat() + '.result').resolve()
+                       + datetime.datetime.now().isoformat() + '.result')
             self.mv_temp(alt_file)
             print(f"Saved calculation results in {alt_file.name}.")
 
@@ -278,18 +487,20 @@ class ProtectFile:
     def release(self, pop=True):
         """Clean up lockfile, tempfile, and backupfile"""
         # Overly verbose in checking, as to make sure this never fails (to avoid being stuck with remnant lockfiles)
+        # Only release once (e.g. in __exit__ and again in __del__), as afterwards
+        # the backup and lockfile might already belong to another process
+        if hasattr(self,'_flock') and hasattr(self._flock,'closed') and self._flock.closed:
+            return
         if hasattr(self,'_fd') and hasattr(self._fd,'closed') and not self._fd.closed:
             self._fd.close()
-        if hasattr(self,'_temp') and hasattr(self._temp,'is_file') and self._temp.is_file():
-            self._temp.unlink()
-        if hasattr(self,'_do_backup') and hasattr(self,'_backup') and \
-                hasattr(self._backup,'is_file') and hasattr(self,'_keep_backup') and \
-                self._do_backup and self._backup.is_file() and not self._keep_backup:
-            self._backup.unlink()
-        if hasattr(self,'_flock') and hasattr(self._flock,'closed') and not self._flock.closed:
-            self._flock.close()
-        if hasattr(self,'_lock') and hasattr(self._lock,'is_file') and self._lock.is_file():
-            self._lock.unlink()
+        # Unlink directly (no stat beforehand), ignoring files that are already gone
+        if hasattr(self,'_temp') and self._temp is not None:
+            self._temp.unlink(missing_ok=True)
+        if hasattr(self,'_backup') and hasattr(self._backup,'unlink') and \
+                hasattr(self,'_keep_backup') and not self._keep_backup:
+            self._backup.unlink(missing_ok=True)
+        if hasattr(self,'_flock') and hasattr(self,'_lock'):
+            _release_lock(self._flock, self._lock)
         if pop:
             protected_open.pop(self._file, 0)
 